@@ -1,9 +1,9 @@
 import os
-from dotenv import load_dotenv
+from app.internal.settings import load_environment
 
 
 # fetch environment variables
-load_dotenv()
+load_environment()
 
 
 def get_google_credentials():
@@ -1,17 +1,110 @@
 import sys
 import argparse
 import os
+import logging
 import requests
-import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import shutil
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from google.cloud import storage
-from io import BytesIO
-from dotenv import load_dotenv
+from app.internal.settings import load_environment
 
-load_dotenv()
+load_environment()
+
+_log = logging.getLogger(__name__)
 
 STORAGE_SERVICE_KEY = os.getenv("STORAGE_SERVICE_KEY")
 
+## (connect, read) timeouts in seconds for each document upload. there is no read timeout:
+## the backend converts the document before it replies, and a timed out upload may still
+## have created its record, so it can't be safely reported as failed or retried
+UPLOAD_TIMEOUT = (5, None)
+
+## maximum number of documents uploaded at the same time. the backend runs 8 workers and
+## converts each document before replying, so leave room for interactive requests
+MAX_UPLOAD_WORKERS = 4
+
+## reuse connections to the backend across uploads instead of opening a new one per file
+_SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(
+    pool_connections=MAX_UPLOAD_WORKERS,
+    pool_maxsize=MAX_UPLOAD_WORKERS,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504]),
+)
+_SESSION.mount("https://", _ADAPTER)
+_SESSION.mount("http://", _ADAPTER)
+_SESSION.headers.update({"Connection": "keep-alive"})
+
+## document types accepted by the backend, keyed by lowercase file extension
+_MIME_BY_EXT = {
+    ".pdf": "application/pdf",
+    ".tif": "image/tiff",
+    ".tiff": "image/tiff",
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+}
+
+
+def _iter_local_files(directory):
+    ## walk with scandir so each entry's type and path come from the directory listing
+    stack = [directory]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    yield entry.name, entry.path
+
+
+def _post_document(post_url, file_name, document, mime_type):
+    _log.info("uploading %s (%s)", file_name, mime_type)
+    upload_files = {
+        "file": (file_name, document, mime_type),
+        "Content-Disposition": 'form-data; name="file"; filename="' + file_name + '"',
+        "Content-Type": mime_type,
+    }
+    _SESSION.post(post_url, files=upload_files, timeout=UPLOAD_TIMEOUT)
+
+
+def _upload_local_file(post_url, file_name, file_path, mime_type):
+    with open(file_path, "rb") as document:
+        _post_document(post_url, file_name, document, mime_type)
+
+
+def _upload_blob(post_url, file_name, blob, mime_type):
+    with blob.open("rb") as document:
+        _post_document(post_url, file_name, document, mime_type)
+
+
+def _upload_documents(post_url, upload, documents):
+    ## documents: (file name, source) pairs, where upload(post_url, file name, source, mime type)
+    ## sends a single source to the backend
+    with ThreadPoolExecutor(max_workers=MAX_UPLOAD_WORKERS) as executor:
+        futures = {}
+        for file_name, source in documents:
+            mime_type = _MIME_BY_EXT.get(os.path.splitext(file_name)[1].lower())
+            if mime_type is None:
+                _log.info("unable to process file type %s", file_name)
+            else:
+                future = executor.submit(upload, post_url, file_name, source, mime_type)
+                futures[future] = file_name
+        ## a failed document shouldn't stop the rest of the upload or the caller's cleanup
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                _log.error("unable to upload %s: %s", futures[future], e)
+
+
+@lru_cache(maxsize=None)
+def _get_storage_client(service_key_path):
+    ## one client (and its connection pool) per service key for the life of the process
+    return storage.Client.from_service_account_json(service_key_path)
+
 
 def upload_documents_from_directory(
     backend_url=None,
@@ -37,88 +130,36 @@ def upload_documents_from_directory(
         backend_url = f"https://server.uow-carbon.org"
     post_url = f"{backend_url}/upload_document/{project_id}/{user_email}"
     if local_directory is not None:
-        files_to_delete = []
-        print(f"uploading documents from {local_directory}")
-        for subdir, dirs, files in os.walk(local_directory):
-            for file in files:
-                file_path = os.path.join(subdir, file)
-                files_to_delete.append(file_path)
-                if ".pdf" in file.lower():
-                    mime_type = "application/pdf"
-                elif ".tif" in file.lower():
-                    mime_type = "image/tiff"
-                elif ".png" in file.lower():
-                    mime_type = "image/png"
-                elif ".jpg" in file.lower():
-                    mime_type = "image/jpeg"
-                elif ".jpeg" in file.lower():
-                    mime_type = "image/jpeg"
-                else:
-                    print(f"unable to process file type {file}")
-                    mime_type = None
-
-                if mime_type is not None:
-                    print(f"uploading: {file_path} with mimetype {mime_type}")
-
-                    opened_file = open(file_path, "rb")
-                    upload_files = {
-                        "file": (file, opened_file, mime_type),
-                        "Content-Disposition": 'form-data; name="file"; filename="'
-                        + file
-                        + '"',
-                        "Content-Type": mime_type,
-                    }
-                    requests.post(post_url, files=upload_files)
-        if delete_local_files:
-            time_to_wait = len(files_to_delete) + 120
-            print(f"removing {files_to_delete} in {time_to_wait} seconds")
-            time.sleep(time_to_wait)
-            try:
-                print(f"removing {files_to_delete}")
-                shutil.rmtree(local_directory)
-            except Exception as e:
-                print(f"unable to delete {files_to_delete}: {e}")
+        _log.info("uploading documents from %s", local_directory)
+        try:
+            _upload_documents(
+                post_url, _upload_local_file, _iter_local_files(local_directory)
+            )
+        finally:
+            ## every upload request has returned by now, so the backend has its own copy of each file
+            if delete_local_files:
+                try:
+                    _log.info("removing %s", local_directory)
+                    shutil.rmtree(local_directory)
+                except Exception as e:
+                    _log.error("unable to delete %s: %s", local_directory, e)
     if cloud_directory is not None and cloud_bucket is not None:
         if storage_service_key is None:
             print(
                 "please provide a valid path to a google storage service key json file"
             )
             return
-        print(f"uploading documents from {cloud_bucket}/{cloud_directory}")
+        _log.info("uploading documents from %s/%s", cloud_bucket, cloud_directory)
         try:
-            client = storage.Client.from_service_account_json(
-                f"./{STORAGE_SERVICE_KEY}"
-            )
+            client = _get_storage_client(f"./{STORAGE_SERVICE_KEY}")
         except Exception as e:
             print(
                 "please provide a valid path to a google storage service key json file"
             )
             return
         bucket = client.bucket(cloud_bucket)
-        for blob in bucket.list_blobs(prefix=cloud_directory):
-            file_name = blob.name.replace(f"{cloud_directory}/", "")
-            if ".pdf" in file_name.lower():
-                mime_type = "application/pdf"
-            elif ".tif" in file_name.lower():
-                mime_type = "image/tiff"
-            elif ".png" in file_name.lower():
-                mime_type = "image/png"
-            elif ".jpg" in file_name.lower():
-                mime_type = "image/jpeg"
-            elif ".jpeg" in file_name.lower():
-                mime_type = "image/jpeg"
-            else:
-                print(f"unable to process file type {file_name}")
-                mime_type = None
-
-            if mime_type is not None:
-                print(f"uploading {mime_type}: {file_name}")
-                doc = BytesIO(blob.download_as_bytes())
-                upload_files = {
-                    "file": (file_name, doc, mime_type),
-                    "Content-Disposition": 'form-data; name="file"; filename="'
-                    + file_name
-                    + '"',
-                    "Content-Type": mime_type,
-                }
-                requests.post(post_url, files=upload_files)
+        blobs = (
+            (blob.name.replace(f"{cloud_directory}/", ""), blob)
+            for blob in bucket.list_blobs(prefix=cloud_directory)
+        )
+        _upload_documents(post_url, _upload_blob, blobs)
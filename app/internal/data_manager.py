@@ -4,16 +4,19 @@ import time
 import os
 import csv
 import json
+import asyncio
 from enum import Enum
 import threading
+from functools import lru_cache
 
 from typing import Union, List
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, Field
 from bson import ObjectId
 from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError
 
 from app.internal.mongodb_connection import connectToDatabase
-from app.internal.settings import AppSettings
+from app.internal.settings import AppSettings, load_environment
 from app.internal.image_handling import (
     generate_download_signed_url_v4,
     delete_google_storage_directory,
@@ -22,6 +25,9 @@ from app.internal.image_handling import (
 
 _log = logging.getLogger(__name__)
 
+load_environment()
+ENVIRONMENT = os.getenv("ENVIRONMENT")
+
 
 class Roles(int, Enum):
     """Roles for user accessibility.
@@ -37,18 +43,156 @@ class Roles(int, Enum):
 class Project(BaseModel):
     """Information about a project."""
 
+    ## projects are read-only snapshots of the db
+    model_config = ConfigDict(frozen=True, extra="ignore")
+
     # static information
     id_: str
     name: str
     description: str = ""
     state: str = ""
-    history: List = []
-    attributes: List = []
+    history: List = Field(default_factory=list)
+    attributes: List = Field(default_factory=list)
     documentType: str = ""
     creator: Union[str, dict] = ""
     dateCreated: Union[float, None] = None
 
 
+## fields of a project document that are used to build a Project
+PROJECT_FIELDS_PROJECTION = {
+    "name": 1,
+    "description": 1,
+    "state": 1,
+    "history": 1,
+    "attributes": 1,
+    "documentType": 1,
+    "creator": 1,
+    "dateCreated": 1,
+}
+
+
+@lru_cache(maxsize=4096)
+def _oid(id_string):
+    ## the same project and record ids are parsed over and over within a request
+    return ObjectId(id_string)
+
+
+def _project_fields(document):
+    ## map a project document onto the fields of a Project
+    return {
+        "id_": str(document.get("_id", None)),
+        "name": document.get("name", ""),
+        "description": document.get("description", ""),
+        "state": document.get("state", ""),
+        "history": document.get("history", []),
+        "attributes": document.get("attributes", []),
+        "documentType": document.get("documentType", ""),
+        "creator": document.get("creator", ""),
+        "dateCreated": document.get("dateCreated", None),
+    }
+
+
+## fields of a user document that are returned when listing users
+USER_FIELDS_PROJECTION = {
+    "_id": 0,
+    "email": 1,
+    "name": 1,
+    "hd": 1,
+    "picture": 1,
+    "role": 1,
+}
+
+## fields of a record document that are read when exporting it
+EXPORT_FIELDS_PROJECTION = {"_id": 0, "attributesList": 1, "filename": 1}
+
+## the csv export only needs the keys and values of each attribute
+CSV_EXPORT_FIELDS_PROJECTION = {
+    "_id": 0,
+    "attributesList.key": 1,
+    "attributesList.value": 1,
+    "attributesList.subattributes.key": 1,
+    "attributesList.subattributes.value": 1,
+    "filename": 1,
+}
+
+
+def _csv_columns(document, selected_columns):
+    ## yield (column, value, is_subattribute) for each selected attribute of a record
+    current_attributes = set()
+    for document_attribute in document["attributesList"]:
+        attribute_name = document_attribute["key"].replace(" ", "")
+        if attribute_name in selected_columns:
+            original_attribute_name = attribute_name
+            i = 2
+            while attribute_name in current_attributes:
+                ## add a number to the end of the attribute so it (and its subattributes)
+                ## is differentiable from other instances of the attribute
+                attribute_name = f"{original_attribute_name}_{i}"
+                i += 1
+            current_attributes.add(attribute_name)
+            yield attribute_name, document_attribute.get("value", None), False
+            ## add subattributes
+            if document_attribute.get("subattributes", None):
+                for document_subattribute in document_attribute["subattributes"]:
+                    subattribute_name = (
+                        f"{attribute_name}[{document_subattribute['key']}]"
+                    )
+                    yield subattribute_name, document_subattribute.get(
+                        "value", None
+                    ), True
+
+
+def _csv_row(document, selected_columns, columns):
+    ## values of a record in the order of the csv header, blank where the record has no value
+    record_attribute = {
+        column: value for column, value, _ in _csv_columns(document, selected_columns)
+    }
+    record_attribute["file"] = document.get("filename", "")
+    return tuple(record_attribute.get(column, "") for column in columns)
+
+
+## keys of a record's attributes and subattributes, without their values
+ATTRIBUTE_KEYS_EXPRESSION = {
+    "$map": {
+        "input": "$attributesList",
+        "as": "attribute",
+        "in": {
+            "key": "$$attribute.key",
+            "subattributes": {
+                "$map": {
+                    "input": {"$ifNull": ["$$attribute.subattributes", []]},
+                    "as": "subattribute",
+                    "in": {"key": "$$subattribute.key"},
+                }
+            },
+        },
+    }
+}
+
+
+def _number_records(documents):
+    ## number a project's records (already sorted by dateCreated) from 1, with string ids
+    records = list(documents)
+    for record_index, document in enumerate(records, start=1):
+        document["_id"] = str(document["_id"])
+        document["recordIndex"] = record_index
+    return records
+
+
+## (collection, keys, options) for indexes backing frequent queries
+INDEXES = [
+    ("records", [("project_id", ASCENDING), ("dateCreated", ASCENDING)], {}),
+    ("users", [("email", ASCENDING)], {"unique": True}),
+    ("users", [("role", ASCENDING)], {}),
+    ("teams", [("name", ASCENDING)], {"unique": True}),
+    ("locked_records", [("record_id", ASCENDING)], {"unique": True}),
+    ("locked_records", [("user", ASCENDING)], {}),
+]
+
+## number of records fetched per round trip when reading all of a project's records
+RECORDS_BATCH_SIZE = 1000
+
+
 class DataManager:
     """Manage the active data."""
 
@@ -57,28 +201,23 @@ class DataManager:
     def __init__(self, **kwargs) -> None:
         self.app_settings = AppSettings(**kwargs)
         self.db = connectToDatabase()
-        self.environment = os.getenv("ENVIRONMENT")
-        _log.info(f"working in environment: {self.environment}")
+        self.createIndexes()
+        self.environment = ENVIRONMENT
+        _log.info("working in environment: %s", self.environment)
 
-        self.LOCKED = False
         ## lock_duration: amount of seconds that records remain locked if no changes are made
         self.lock_duration = 120
 
-    def fetchLock(self, user):
-        ## Can't use variable stored in memory for this
-        while self.LOCKED and self.LOCKED != user:
-            _log.info(f"{user} waiting for lock")
-            time.sleep(0.1)
-        self.LOCKED = user
-        _log.info(f"{user} grabbed lock")
-
-    def releaseLock(self, user):
-        ## Can't use variable stored in memory for this
-        _log.info(f"{user} releasing lock")
-        self.LOCKED = False
+    def createIndexes(self):
+        ## create_index is a no-op for indexes that already exist
+        for collection, keys, options in INDEXES:
+            try:
+                self.db[collection].create_index(keys, **options)
+            except Exception as e:
+                _log.error("unable to create index %s on %s: %s", keys, collection, e)
 
     def lockRecord(self, record_id, user, release_previous_record=True):
-        _log.info(f"{user} locking {record_id}")
+        _log.info("%s locking %s", user, record_id)
         if release_previous_record:
             ## remove any record locks that this user may already have in place
             self.releaseRecord(user=user)
@@ -91,76 +230,71 @@ class DataManager:
         self.db.locked_records.update_one(query, {"$set": data}, upsert=True)
 
     def releaseRecord(self, record_id=None, user=None):
-        _log.info(f"releasing record {record_id} or user {user}")
+        _log.info("releasing record %s or user %s", record_id, user)
         if record_id:
             self.db.locked_records.delete_many({"record_id": record_id})
         elif user:
             self.db.locked_records.delete_many({"user": user})
 
     def tryLockingRecord(self, record_id, user):
+        ## claim the record with a single conditional upsert so that concurrent requests, in this
+        ## worker or any other, can't both take it. the query matches if this user already holds
+        ## the lock or it has expired. if someone else holds a valid lock, the upsert collides
+        ## with the unique record_id index instead
+        current_time = time.time()
+        query = {
+            "record_id": record_id,
+            "$or": [
+                {"user": user},
+                {"timestamp": {"$lt": current_time - self.lock_duration}},
+            ],
+        }
+        data = {
+            "user": user,
+            "record_id": record_id,
+            "timestamp": current_time,
+        }
         try:
-            # self.fetchLock(user)
-            attained_lock = False
-            locked_record_cursor = self.db.locked_records.find({"record_id": record_id})
-            record_is_locked = False
-            for locked_record_document in locked_record_cursor:
-                record_is_locked = True
-                break
-            locked_record_cursor.close()
-            _log.info(f"record_is_locked: {record_is_locked}")
-            if record_is_locked:
-                ## someone has a lock for this.
-                ## (1) check who
-                ## (2) check if expired
-                locked_time = locked_record_document.get("timestamp", 0)
-                lockholder = locked_record_document.get("user", None)
-                current_time = time.time()
-                if lockholder == user:
-                    self.lockRecord(
-                        record_id=record_id, user=user, release_previous_record=False
-                    )
-                    attained_lock = True
-                elif locked_time + self.lock_duration < current_time:
-                    ## lock is expired
-                    self.lockRecord(
-                        record_id=record_id, user=user, release_previous_record=True
-                    )
-                    attained_lock = True
-                else:
-                    ## lock is still valid by other user
-                    attained_lock = False
-            else:
-                ## record is unlocked, go on ahead
-                self.lockRecord(
-                    record_id=record_id, user=user, release_previous_record=True
-                )
-                attained_lock = True
-            # self.releaseLock(user)
-            return attained_lock
+            previous_lock = self.db.locked_records.find_one_and_update(
+                query, {"$set": data}, {"user": 1}, upsert=True
+            )
+        except DuplicateKeyError:
+            ## lock is still valid by other user
+            return False
         except Exception as e:
-            _log.error(f"error trying to lock record: {e}")
+            _log.error("error trying to lock record: %s", e)
             return False
+        _log.info("%s locking %s", user, record_id)
+        if previous_lock is None or previous_lock.get("user", None) != user:
+            ## remove any record locks that this user may already have in place
+            self.db.locked_records.delete_many(
+                {"user": user, "record_id": {"$ne": record_id}}
+            )
+        return True
 
-    def getDocument(self, collection, query, clean_id=False, return_list=False):
+    def getDocument(
+        self, collection, query, clean_id=False, return_list=False, projection=None
+    ):
         try:
-            cursor = self.db[collection].find(query)
             if not return_list:
-                document = cursor.next()
+                document = self.db[collection].find_one(query, projection)
+                if document is None:
+                    _log.error("unable to find %s in %s", query, collection)
+                    return None
                 if clean_id:
                     document_id = document.get("_id", "")
                     document["_id"] = str(document_id)
                 return document
         except Exception as e:
-            _log.error(f"unable to find {query} in {collection}: {e}")
+            _log.error("unable to find %s in %s: %s", query, collection, e)
             return None
 
     def checkForUser(
         self, user_info, update=True, add=True, team="Testing", login=False
     ):
-        cursor = self.db.users.find({"email": user_info["email"]})
-        foundUser = False
-        for document in cursor:
-            foundUser = True
+        document = self.db.users.find_one({"email": user_info["email"]}, {"role": 1})
+        foundUser = document is not None
+        if foundUser:
             role = document.get("role", Roles.pending)
             if update:
                 self.updateUser(user_info)
@@ -175,8 +309,8 @@ class DataManager:
         return role
 
     def addUser(self, user_info, default_team, role=Roles.pending):
-        _log.info(f"adding user {user_info}")
-        _log.info(f"team is {default_team}")
+        _log.info("adding user %s", user_info)
+        _log.info("team is %s", default_team)
         user = {
             "email": user_info.get("email", ""),
             "name": user_info.get("name", ""),
@@ -193,31 +327,24 @@ class DataManager:
 
         ## add user to team's users
         team_query = {"name": default_team}
-        team_document = self.getDocument("teams", team_query)
-        team_users = team_document.get("users", [])
-        team_users.append(user_info.get("email", ""))
-        newvalues = {"$set": {"users": team_users}}
+        newvalues = {"$addToSet": {"users": user_info.get("email", "")}}
         self.db.teams.update_one(team_query, newvalues)
 
         return db_response
 
     def addUserToTeam(self, email, team, role=Roles.base_user):
-        ## CHECK IF USER IS NOT ALREADY ON THIS TEAM
-        checkvalues = {"name": team, "users": email}
-        found_user = self.db.teams.count_documents(checkvalues)
-        if found_user > 0:
-            _log.info(f"found {email} on {team}")
-            return "already_exists"
-
         ## update user's teams
         # myquery = {"email": email}
         # newvalues = { "$push": { "teams": team } }
         # cursor = self.db.users.update_one(myquery, newvalues)
 
-        ## update team's users
+        ## update team's users. $addToSet leaves the team untouched if the user is already on it
         myquery = {"name": team}
-        newvalues = {"$push": {"users": email}}
+        newvalues = {"$addToSet": {"users": email}}
         cursor = self.db.teams.update_one(myquery, newvalues)
+        if cursor.matched_count > 0 and cursor.modified_count == 0:
+            _log.info("found %s on %s", email, team)
+            return "already_exists"
         return "success"
 
     def updateUser(self, user_info):
@@ -242,44 +369,67 @@ class DataManager:
 
     def getUserProjectList(self, user):
         user_query = {"email": user}
-        user_cursor = self.db.users.find(user_query)
-        user_document = user_cursor.next()
+        user_document = self.db.users.find_one(user_query, {"default_team": 1})
         default_team = user_document.get("default_team", None)
 
         team_query = {"name": default_team}
-        team_cursor = self.db.teams.find(team_query)
-        team_document = team_cursor.next()
+        team_document = self.db.teams.find_one(team_query, {"projects": 1})
         projects = team_document.get("projects", [])
         return projects
 
+    def canAccessProject(self, user, project_id):
+        ## ask the user's team for just this project rather than pulling its whole project list
+        user_document = self.db.users.find_one({"email": user}, {"default_team": 1})
+        if user_document is None:
+            return False
+        team_query = {
+            "name": user_document.get("default_team", None),
+            "projects": project_id,
+        }
+        return self.db.teams.find_one(team_query, {"_id": 1}) is not None
+
     def fetchProjects(self, user):
-        user_projects = self.getUserProjectList(user)
-        projects = []
-        cursor = self.db.projects.find({"_id": {"$in": user_projects}})
-        for document in cursor:
-            projects.append(
-                Project(
-                    id_=str(document.get("_id", None)),
-                    name=document.get("name", ""),
-                    description=document.get("description", ""),
-                    state=document.get("state", ""),
-                    history=document.get("history", []),
-                    attributes=document.get("attributes", []),
-                    documentType=document.get("documentType", ""),
-                    creator=document.get("creator", ""),
-                    dateCreated=document.get("dateCreated", None),
-                )
-            )
-        return projects
+        ## user -> default team -> team's projects in a single round trip
+        cursor = self.db.users.aggregate(
+            [
+                {"$match": {"email": user}},
+                {
+                    "$lookup": {
+                        "from": "teams",
+                        "localField": "default_team",
+                        "foreignField": "name",
+                        "as": "team",
+                    }
+                },
+                {"$unwind": "$team"},
+                {
+                    "$lookup": {
+                        "from": "projects",
+                        "localField": "team.projects",
+                        "foreignField": "_id",
+                        "as": "project",
+                    }
+                },
+                {"$unwind": "$project"},
+                {"$replaceRoot": {"newRoot": "$project"}},
+                {"$project": PROJECT_FIELDS_PROJECTION},
+            ]
+        )
+        ## documents come from our own db, so skip pydantic validation
+        return [
+            Project.model_construct(**_project_fields(document)) for document in cursor
+        ]
 
     def createProject(self, project_info, user_info):
         ## get user's default team
         user_email = user_info.get("email", "")
-        user_document = self.getDocument("users", ({"email": user_email}))
+        user_document = self.getDocument(
+            "users", {"email": user_email}, projection={"default_team": 1}
+        )
         default_team = user_document.get("default_team", None)
         if default_team is None:
             ## TODO: handle project creation when a user has no default project
-            _log.info(f"user {user_email} has no default team")
+            _log.info("user %s has no default team", user_email)
             return False
 
         ## add user and timestamp to project
@@ -294,10 +444,7 @@ class DataManager:
 
         ## add project to team's project list:
         team_query = {"name": default_team}
-        team_document = self.getDocument("teams", team_query)
-        team_projects = team_document.get("projects", [])
-        team_projects.append(new_project_id)
-        newvalues = {"$set": {"projects": team_projects}}
+        newvalues = {"$push": {"projects": new_project_id}}
         self.db.teams.update_one(team_query, newvalues)
 
         self.recordHistory("createProject", user_email, str(new_project_id))
@@ -306,77 +453,79 @@ class DataManager:
 
     def fetchProjectData(self, project_id, user):
         ## get user's projects, check if user has access to this project
-        user_projects = self.getUserProjectList(user)
-        _id = ObjectId(project_id)
-        if not _id in user_projects:
+        _id = _oid(project_id)
+        if not self.canAccessProject(user, _id):
             return None, None
 
         ## get project data
-        cursor = self.db.projects.find({"_id": _id})
-        project_data = cursor.next()
+        project_data = self.db.projects.find_one({"_id": _id})
+        if project_data is None:
+            return None, None
         project_data["id_"] = str(project_data["_id"])
         del project_data["_id"]
 
         ## get project's records
-        records = []
-        cursor = self.db.records.find({"project_id": project_id}).sort(
-            "dateCreated", ASCENDING
+        cursor = (
+            self.db.records.find({"project_id": project_id})
+            .sort("dateCreated", ASCENDING)
+            .batch_size(RECORDS_BATCH_SIZE)
         )
-        record_index = 1
-        for document in cursor:
-            document["_id"] = str(document["_id"])
-            document["recordIndex"] = record_index
-            record_index += 1
-            records.append(document)
+        records = _number_records(cursor)
         return project_data, records
 
     def getTeamRecords(self, user_info):
         user = user_info.get("email", "")
         ## get user's projects, check if user has access to this project
-        user_document = self.getDocument("users", {"email": user})
+        user_document = self.getDocument(
+            "users", {"email": user}, projection={"default_team": 1}
+        )
         default_team = user_document.get("default_team", None)
-        team_document = self.getDocument("teams", {"name": default_team})
+        team_document = self.getDocument(
+            "teams", {"name": default_team}, projection={"projects": 1}
+        )
         projects_list = team_document.get("projects", [])
         records = []
-        for _id in projects_list:
-            project_id = str(_id)
-            ## get project data
-            cursor = self.db.projects.find({"_id": _id})
-            ## errors out sometimes ?
-            try:
-                project_data = cursor.next()
-                project_data["id_"] = str(project_data["_id"])
-                del project_data["_id"]
-                # _log.info(f"checking for records with project_id {project_id}")
-                cursor = self.db.records.find({"project_id": project_id}).sort(
-                    "dateCreated", ASCENDING
-                )
-                record_index = 1
-                for document in cursor:
-                    document["_id"] = str(document["_id"])
-                    document["recordIndex"] = record_index
-                    record_index += 1
-                    records.append(document)
-            except Exception as e:
-                _log.error(f"unable to add records from project {project_id}: {e}")
+        ## skip projects that no longer exist
+        existing_projects = {
+            document["_id"]
+            for document in self.db.projects.find(
+                {"_id": {"$in": projects_list}}, {"_id": 1}
+            )
+        }
+        project_ids = [str(_id) for _id in projects_list if _id in existing_projects]
+        ## get every project's records at once, then number them within each project
+        project_records = {project_id: [] for project_id in project_ids}
+        try:
+            cursor = (
+                self.db.records.find({"project_id": {"$in": project_ids}})
+                .sort("dateCreated", ASCENDING)
+                .batch_size(RECORDS_BATCH_SIZE)
+            )
+            for document in cursor:
+                project_records[document["project_id"]].append(document)
+        except Exception as e:
+            _log.error("unable to add records from projects %s: %s", project_ids, e)
+        for project_id in project_ids:
+            records.extend(_number_records(project_records[project_id]))
         return records
 
     def fetchRecordData(self, record_id, user_info, direction="next"):
         user = user_info.get("email", "")
-        _id = ObjectId(record_id)
-        cursor = self.db.records.find({"_id": _id})
-        document = cursor.next()
+        _id = _oid(record_id)
+        document = self.db.records.find_one({"_id": _id})
+        if document is None:
+            _log.info("unable to find record %s", record_id)
+            return None, None
         document["_id"] = str(document["_id"])
         projectId = document.get("project_id", "")
-        project_id = ObjectId(projectId)
+        project_id = _oid(projectId)
 
         ## check that record is not locked
         attained_lock = self.tryLockingRecord(record_id, user)
         if not attained_lock:
             return document, True
 
-        user_projects = self.getUserProjectList(user)
-        if not project_id in user_projects:
+        if not self.canAccessProject(user, project_id):
             return None, None
         image_urls = []
         for image in document.get("image_files", []):
@@ -393,49 +542,84 @@ class DataManager:
             )
         document["img_urls"] = image_urls
 
-        ## get project name
-        project = self.getDocument("projects", {"_id": project_id})
-        project_name = project.get("name", "")
-        document["project_name"] = project_name
-
-        ## get record index
+        ## get record index and project name in one round trip:
+        ## count the project's records up to this one, then join the project onto the count
         dateCreated = document.get("dateCreated", 0)
         record_index_query = {
             "dateCreated": {"$lte": dateCreated},
             "project_id": projectId,
         }
-        record_index = self.db.records.count_documents(record_index_query)
+        cursor = self.db.records.aggregate(
+            [
+                {"$match": record_index_query},
+                {
+                    "$group": {
+                        "_id": {"$literal": project_id},
+                        "recordIndex": {"$sum": 1},
+                    }
+                },
+                {
+                    "$lookup": {
+                        "from": "projects",
+                        "localField": "_id",
+                        "foreignField": "_id",
+                        "as": "project",
+                    }
+                },
+                {"$project": {"recordIndex": 1, "project.name": 1}},
+            ]
+        )
+        record_index_document = next(cursor, None)
+        if record_index_document is not None:
+            record_index = record_index_document["recordIndex"]
+            project = next(iter(record_index_document["project"]), {})
+        else:
+            ## no records counted (e.g. record without a dateCreated)
+            record_index = 0
+            project = (
+                self.getDocument(
+                    "projects", {"_id": project_id}, projection={"name": 1}
+                )
+                or {}
+            )
+        document["project_name"] = project.get("name", "")
         document["recordIndex"] = record_index
 
         return document, False
 
     def fetchNextRecord(self, dateCreated, projectId, user_info):
         # _log.info(f"fetching next record\n{dateCreated}\n{projectId}\n{user_info}")
-        cursor = self.db.records.find(
-            {"dateCreated": {"$gt": dateCreated}, "project_id": projectId}
-        ).sort("dateCreated", ASCENDING)
-        for document in cursor:
+        ## only the id is needed to fetch the neighbouring record
+        document = self.db.records.find_one(
+            {"dateCreated": {"$gt": dateCreated}, "project_id": projectId},
+            {"_id": 1},
+            sort=[("dateCreated", ASCENDING)],
+        )
+        if document is not None:
             record_id = str(document.get("_id", ""))
             return self.fetchRecordData(record_id, user_info, direction="next")
-        cursor = self.db.records.find({"project_id": projectId}).sort(
-            "dateCreated", ASCENDING
+        ## wrap around to the project's first record
+        document = self.db.records.find_one(
+            {"project_id": projectId}, {"_id": 1}, sort=[("dateCreated", ASCENDING)]
         )
-        document = cursor.next()
         record_id = str(document.get("_id", ""))
         return self.fetchRecordData(record_id, user_info)
 
     def fetchPreviousRecord(self, dateCreated, projectId, user_info):
-        _log.info(f"fetching previous record")
-        cursor = self.db.records.find(
-            {"dateCreated": {"$lt": dateCreated}, "project_id": projectId}
-        ).sort("dateCreated", DESCENDING)
-        for document in cursor:
+        _log.info("fetching previous record")
+        ## only the id is needed to fetch the neighbouring record
+        document = self.db.records.find_one(
+            {"dateCreated": {"$lt": dateCreated}, "project_id": projectId},
+            {"_id": 1},
+            sort=[("dateCreated", DESCENDING)],
+        )
+        if document is not None:
             record_id = str(document.get("_id", ""))
             return self.fetchRecordData(record_id, user_info, direction="previous")
-        cursor = self.db.records.find({"project_id": projectId}).sort(
-            "dateCreated", DESCENDING
+        ## wrap around to the project's last record
+        document = self.db.records.find_one(
+            {"project_id": projectId}, {"_id": 1}, sort=[("dateCreated", DESCENDING)]
         )
-        document = cursor.next()
         record_id = str(document.get("_id", ""))
         return self.fetchRecordData(record_id, user_info)
 
@@ -451,7 +635,7 @@ class DataManager:
 
     def updateProject(self, project_id, new_data, user_info={}):
         user = user_info.get("email", None)
-        _id = ObjectId(project_id)
+        _id = _oid(project_id)
         ## need to choose a subset of the data to update. can't update entire record because _id is immutable
         myquery = {"_id": _id}
         newvalues = {"$set": new_data}
@@ -459,15 +643,6 @@ class DataManager:
         self.recordHistory("updateProject", user, project_id)
         return "success"
 
-    def updateUserProjects(self, email, new_data):
-        _log.info(f"updating {email} to be {new_data}")
-        ## need to choose a subset of the data to update. can't update entire record because _id is immutable
-        myquery = {"email": email}
-        newvalues = {"$set": new_data}
-        self.db.users.update_one(myquery, newvalues)
-        # _log.info(f"successfully updated project? cursor is : {cursor}")
-        return "success"
-
     def updateRecordReviewStatus(self, record_id, review_status, user_info):
         new_data = {"review_status": review_status}
         self.updateRecord(record_id, new_data, "record", user_info)
@@ -486,7 +661,7 @@ class DataManager:
         if attained_lock or forceUpdate:
             if update_type is None:
                 return False
-            _id = ObjectId(record_id)
+            _id = _oid(record_id)
             search_query = {"_id": _id}
             if update_type == "record":
                 data_update = new_data
@@ -512,7 +687,7 @@ class DataManager:
             return False
 
     def resetRecord(self, record_id, record_data, user):
-        print(f"resetting record: {record_id}")
+        _log.info("resetting record: %s", record_id)
         record_attributes = record_data["attributesList"]
         for attribute in record_attributes:
             attribute_name = attribute["key"]
@@ -543,18 +718,19 @@ class DataManager:
 
     def deleteProject(self, project_id, background_tasks, user_info):
         ## TODO: check if user is a part of the team who owns this project
-        _log.info(f"deleting project {project_id}")
-        _id = ObjectId(project_id)
+        _log.info("deleting project %s", project_id)
+        _id = _oid(project_id)
         myquery = {"_id": _id}
 
         ## add to deleted projects collection first
-        project_cursor = self.db.projects.find(myquery)
         try:
-            project_document = project_cursor.next()
+            project_document = self.db.projects.find_one(myquery)
             project_document["deleted_by"] = user_info
             self.db.deleted_projects.insert_one(project_document)
         except Exception as e:
-            _log.error(f"unable to add project {project_id} to deleted projects: {e}")
+            _log.error(
+                "unable to add project %s to deleted projects: %s", project_id, e
+            )
 
         ## delete from projects collection
         self.db.projects.delete_one(myquery)
@@ -581,8 +757,8 @@ class DataManager:
     def deleteRecord(self, record_id, user_info):
         user = user_info.get("email", None)
         ## TODO: check if user is a part of the team who owns the project that owns this record
-        _log.info(f"deleting {record_id}")
-        _id = ObjectId(record_id)
+        _log.info("deleting %s", record_id)
+        _id = _oid(record_id)
         myquery = {"_id": _id}
         self.db.records.delete_one(myquery)
         self.recordHistory("deleteRecord", user=user, record_id=record_id)
@@ -590,15 +766,25 @@ class DataManager:
 
     def deleteRecords(self, query, deletedBy):
         user = deletedBy.get("email", None)
-        _log.info(f"deleting records with query: {query}")
+        _log.info("deleting records with query: %s", query)
         ## add records to deleted records collection
-        record_cursor = self.db.records.find(query)
         try:
-            for record_document in record_cursor:
-                record_document["deleted_by"] = deletedBy
-                self.db.deleted_records.insert_one(record_document)
+            ## copy the records server side instead of sending each one through the app
+            self.db.records.aggregate(
+                [
+                    {"$match": query},
+                    {"$addFields": {"deleted_by": {"$literal": deletedBy}}},
+                    {
+                        "$merge": {
+                            "into": "deleted_records",
+                            "whenMatched": "replace",
+                            "whenNotMatched": "insert",
+                        }
+                    },
+                ]
+            )
         except Exception as e:
-            _log.error(f"unable to move all deleted records: {e}")
+            _log.error("unable to move all deleted records: %s", e)
 
         ## Delete records associated with this project
         self.db.records.delete_many(query)
@@ -606,85 +792,101 @@ class DataManager:
         return "success"
 
     def getProcessor(self, project_id):
-        _id = ObjectId(project_id)
+        _id = _oid(project_id)
         try:
-            cursor = self.db.projects.find({"_id": _id})
-            document = cursor.next()
+            document = self.db.projects.find_one(
+                {"_id": _id}, {"processorId": 1, "attributes": 1}
+            )
             processor_id = document.get("processorId", None)
             processor_attributes = document.get("attributes", None)
             return processor_id, processor_attributes
         except Exception as e:
-            _log.error(f"unable to find processor id: {e}")
+            _log.error("unable to find processor id: %s", e)
             return None
 
     def downloadRecords(self, project_id, exportType, selectedColumns, user_info):
         user = user_info.get("email", None)
         ## TODO: check if user is a part of the team who owns this project
 
-        _id = ObjectId(project_id)
+        _id = _oid(project_id)
         today = time.time()
         output_dir = self.app_settings.export_dir
         output_file = os.path.join(output_dir, f"{project_id}_{today}.{exportType}")
-        project_cursor = self.db.projects.find({"_id": _id})
+        project_document = self.db.projects.find_one(
+            {"_id": _id}, {"name": 1, "settings": 1}
+        )
         attributes = ["file"]
         subattributes = []
-        project_document = project_cursor.next()
         # for each in project_document.get("attributes", {}):
         #     if each["name"] in selectedColumns:
         #         attributes.append(each["name"])
         project_name = project_document.get("name", "")
-        cursor = self.db.records.find({"project_id": project_id})
-        record_attributes = []
+        records_query = {"project_id": project_id}
+        ## membership is checked for every attribute of every record
+        selected_columns = set(selectedColumns)
         if exportType == "csv":
-            for document in cursor:
-                current_attributes = set()
-                record_attribute = {}
-                for document_attribute in document["attributesList"]:
-                    attribute_name = document_attribute["key"].replace(" ", "")
-                    if attribute_name in selectedColumns:
-                        original_attribute_name = attribute_name
-                        i = 2
-                        while attribute_name in current_attributes:
-                            ## add a number to the end of the attribute so it (and its subattributes)
-                            ## is differentiable from other instances of the attribute
-                            attribute_name = f"{original_attribute_name}_{i}"
-                            i += 1
-                        current_attributes.add(attribute_name)
-                        if attribute_name not in attributes:
-                            attributes.append(attribute_name)
-                        record_attribute[attribute_name] = document_attribute["value"]
-                        ## add subattributes
-                        if document_attribute.get("subattributes", None):
-                            for document_subattribute in document_attribute[
-                                "subattributes"
-                            ]:
-                                subattribute_name = (
-                                    f"{attribute_name}[{document_subattribute['key']}]"
-                                )
-                                record_attribute[
-                                    subattribute_name
-                                ] = document_subattribute["value"]
-                                if subattribute_name not in subattributes:
-                                    subattributes.append(subattribute_name)
-                record_attribute["file"] = document.get("filename", "")
-                record_attributes.append(record_attribute)
-
-            # compute the output file directory and name
+            ## first pass: find every column that appears in the project's records.
+            ## records from the same processor share a layout of attribute keys, so only
+            ## the distinct layouts are sent back, in order of their first record
+            cursor = self.db.records.aggregate(
+                [
+                    {"$match": records_query},
+                    {"$project": {"attributesList": ATTRIBUTE_KEYS_EXPRESSION}},
+                    {
+                        "$group": {
+                            "_id": "$attributesList",
+                            "first_record": {"$min": "$_id"},
+                        }
+                    },
+                    {"$sort": {"first_record": ASCENDING}},
+                ],
+                allowDiskUse=True,
+            )
+            ## sets mirror the column lists so membership checks don't scan them
+            seen_attributes = set(attributes)
+            seen_subattributes = set()
+            for layout in cursor:
+                for column, _, is_subattribute in _csv_columns(
+                    {"attributesList": layout["_id"]}, selected_columns
+                ):
+                    if is_subattribute:
+                        if column not in seen_subattributes:
+                            seen_subattributes.add(column)
+                            subattributes.append(column)
+                    elif column not in seen_attributes:
+                        seen_attributes.add(column)
+                        attributes.append(column)
+
+            ## second pass: stream one row per record straight into the file
+            cursor = self.db.records.find(
+                records_query, CSV_EXPORT_FIELDS_PROJECTION
+            ).batch_size(RECORDS_BATCH_SIZE)
             with open(output_file, "w", newline="") as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=attributes + subattributes)
-                writer.writeheader()
-                writer.writerows(record_attributes)
+                ## columns from records uploaded after the first pass are left out
+                columns = attributes + subattributes
+                writer = csv.writer(csvfile)
+                writer.writerow(columns)
+                writer.writerows(
+                    _csv_row(document, selected_columns, columns) for document in cursor
+                )
         else:
-            for document in cursor:
-                record_attribute = {}
-                for document_attribute in document["attributesList"]:
-                    attribute_name = document_attribute["key"]
-                    if attribute_name in selectedColumns:
-                        record_attribute[attribute_name] = document_attribute
-                record_attribute["file"] = document.get("filename", "")
-                record_attributes.append(record_attribute)
+            cursor = self.db.records.find(
+                records_query, EXPORT_FIELDS_PROJECTION
+            ).batch_size(RECORDS_BATCH_SIZE)
+            ## write the array one record at a time instead of building it in memory
             with open(output_file, "w", newline="") as jsonfile:
-                json.dump(record_attributes, jsonfile)
+                jsonfile.write("[")
+                for i, document in enumerate(cursor):
+                    record_attribute = {}
+                    for document_attribute in document["attributesList"]:
+                        attribute_name = document_attribute["key"]
+                        if attribute_name in selected_columns:
+                            record_attribute[attribute_name] = document_attribute
+                    record_attribute["file"] = document.get("filename", "")
+                    if i > 0:
+                        jsonfile.write(", ")
+                    json.dump(record_attribute, jsonfile)
+                jsonfile.write("]")
 
         ## update export attributes in project document
         settings = project_document.get("settings", {})
@@ -694,19 +896,19 @@ class DataManager:
         self.recordHistory("downloadRecords", user=user, project_id=project_id)
         return output_file
 
-    def deleteFiles(self, filepaths, sleep_time=5):
-        _log.info(f"deleting files: {filepaths} in {sleep_time} seconds")
-        time.sleep(sleep_time)
+    async def deleteFiles(self, filepaths, sleep_time=5):
+        _log.info("deleting files: %s in %s seconds", filepaths, sleep_time)
+        ## wait on the event loop rather than holding a threadpool worker
+        await asyncio.sleep(sleep_time)
         for filepath in filepaths:
             if os.path.isfile(filepath):
                 os.remove(filepath)
-                _log.info(f"deleted {filepath}")
+                _log.info("deleted %s", filepath)
 
     def hasRole(self, user_info, role=Roles.admin):
         email = user_info.get("email", "")
-        cursor = self.db.users.find({"email": email})
         try:
-            document = cursor.next()
+            document = self.db.users.find_one({"email": email}, {"role": 1})
             if document.get("role", Roles.pending) == role:
                 return True
             else:
@@ -723,44 +925,33 @@ class DataManager:
     ):
         ## TODO: accept team id as parameter and use that to determine which users to return
         user = user_info.get("email", "")
-        user_document = self.getDocument("users", {"email": user})
+        user_document = self.getDocument(
+            "users", {"email": user}, projection={"default_team": 1}
+        )
         team_id = user_document.get("default_team", None)
-        team_document = self.getDocument("teams", {"name": team_id})
+        team_document = self.getDocument(
+            "teams", {"name": team_id}, projection={"users": 1}
+        )
         team_users = team_document.get("users", [])
         if includeLowerRoles:  # get all users with provided role or lower
             query = {"role": {"$lte": role}}
         else:  # get only users with provided role
             query = {"role": role}
-        cursor = self.db.users.find(query)
-        users = []
+        ## only return members of this team who aren't already on the excluded project
+        query["email"] = {"$in": team_users}
         if project_id_exclude is not None:
-            project_id = ObjectId(project_id_exclude)
-            for document in cursor:
-                if project_id not in document.get("projects", []):
-                    next_user = document.get("email", "")
-                    if next_user in team_users:
-                        users.append(
-                            {
-                                "email": document.get("email", ""),
-                                "name": document.get("name", ""),
-                                "hd": document.get("hd", ""),
-                                "picture": document.get("picture", ""),
-                                "role": document.get("role", -1),
-                            }
-                        )
-        else:
-            for document in cursor:
-                next_user = document.get("email", "")
-                if next_user in team_users:
-                    users.append(
-                        {
-                            "email": document.get("email", ""),
-                            "name": document.get("name", ""),
-                            "hd": document.get("hd", ""),
-                            "picture": document.get("picture", ""),
-                            "role": document.get("role", -1),
-                        }
-                    )
+            query["projects"] = {"$ne": _oid(project_id_exclude)}
+        cursor = self.db.users.find(query, USER_FIELDS_PROJECTION)
+        users = [
+            {
+                "email": document.get("email", ""),
+                "name": document.get("name", ""),
+                "hd": document.get("hd", ""),
+                "picture": document.get("picture", ""),
+                "role": document.get("role", -1),
+            }
+            for document in cursor
+        ]
         return users
 
     def removeUserFromTeam(self, user, team):
@@ -774,42 +965,34 @@ class DataManager:
         delete_response = self.db.users.delete_one(query)
         ## TODO: remove user form all teams that include him/her
         query = {"users": email}
-        teams_cursor = self.db.teams.find(query)
-        for document in teams_cursor:
-            team_id = document["_id"]
-            user_list = document.get("users", [])
-            user_list.remove(email)
-            query = {"_id": team_id}
-            newvalue = {"$set": {"users": user_list}}
-            self.db.teams.update_one(query, newvalue)
+        newvalue = {"$pull": {"users": email}}
+        self.db.teams.update_many(query, newvalue)
         self.recordHistory("deleteUser", user=admin_email)
         return email
 
     def addUsersToProject(self, users, project_id):
         ## TODO:
         ## (1) change project to team
-        _id = ObjectId(project_id)
+        _id = _oid(project_id)
         try:
-            for user in users:
-                email = user.get("email", "")
-                query = {"email": email}
-                cursor = self.db.users.find(query)
-                user_object = cursor.next()
-                user_projects = user_object.get("projects", [])
-                user_projects.append(_id)
-                update_query = {"projects": user_projects}
-                self.updateUserProjects(email, update_query)
+            emails = [user.get("email", "") for user in users]
+            _log.info("adding %s to project %s", emails, project_id)
+            query = {"email": {"$in": emails}}
+            newvalues = {"$addToSet": {"projects": _id}}
+            self.db.users.update_many(query, newvalues)
             return {"result": "success"}
         except Exception as e:
-            _log.error(f"unable to add users: {e}")
+            _log.error("unable to add users: %s", e)
             return {"result": f"{e}"}
 
     def checkProjectValidity(self, projectId):
         try:
-            project_id = ObjectId(projectId)
+            project_id = _oid(projectId)
         except:
             return False
-        project = self.getDocument("projects", {"_id": project_id})
+        project = self.getDocument(
+            "projects", {"_id": project_id}, projection={"_id": 1}
+        )
         if project is not None:
             return True
 
@@ -827,7 +1010,18 @@ class DataManager:
             }
             self.db.history.insert_one(history_item)
         except Exception as e:
-            _log.error(f"unable to record history item: {e}")
+            _log.error("unable to record history item: %s", e)
+
+
+_data_manager = None
+_data_manager_lock = threading.Lock()
 
 
-data_manager = DataManager()
+def get_data_manager():
+    """Return the shared DataManager, connecting to the db on first use."""
+    global _data_manager
+    if _data_manager is None:
+        with _data_manager_lock:
+            if _data_manager is None:
+                _data_manager = DataManager()
+    return _data_manager
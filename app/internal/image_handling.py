@@ -16,14 +16,18 @@ import zipfile
 import mimetypes
 
 from app.internal.bulk_upload import upload_documents_from_directory
+from app.internal.settings import load_environment
 
 _log = logging.getLogger(__name__)
 
+load_environment()
+
 LOCATION = os.getenv("LOCATION")
 PROJECT_ID = os.getenv("PROJECT_ID")
 PROCESSOR_ID = os.getenv("PROCESSOR_ID")
 STORAGE_SERVICE_KEY = os.getenv("STORAGE_SERVICE_KEY")
 BUCKET_NAME = os.getenv("STORAGE_BUCKET_NAME")
+BACKEND_URL = os.getenv("BACKEND_URL")
 os.environ["GCLOUD_PROJECT"] = PROJECT_ID
 DIRNAME, FILENAME = os.path.split(os.path.abspath(sys.argv[0]))
 
@@ -56,10 +60,9 @@ def process_zip(
             # if it is not a document file, remove it
             if mime_type is None:
                 os.remove(unzipped_img_filepath)
-    backend_url = os.getenv("BACKEND_URL")
     background_tasks.add_task(
         upload_documents_from_directory,
-        backend_url=backend_url,
+        backend_url=BACKEND_URL,
         user_email=user_info["email"],
         project_id=project_id,
         local_directory=zip_path,
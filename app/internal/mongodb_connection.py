@@ -1,13 +1,14 @@
 import os
 import certifi
-from dotenv import load_dotenv
 import urllib.parse
+from functools import lru_cache
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
+from app.internal.settings import load_environment
 
 
 # fetch environment variables
-load_dotenv()
+load_environment()
 DB_USERNAME = os.getenv("DB_USERNAME")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_NAME = os.getenv("DB_NAME")
@@ -16,6 +17,8 @@ DB_CONNECTION = os.getenv("DB_CONNECTION")
 ca = certifi.where()
 
 
+## one client (and its connection pool) per process, shared by every caller
+@lru_cache(maxsize=1)
 def connectToDatabase():
     username = urllib.parse.quote_plus(DB_USERNAME)
     password = urllib.parse.quote_plus(DB_PASSWORD)
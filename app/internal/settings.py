@@ -3,11 +3,19 @@ Configuration for the backend
 """
 from pathlib import Path
 import logging
+from functools import lru_cache
 from typing import List, Union
+from dotenv import load_dotenv
 from pydantic import field_validator
 from pydantic_settings import BaseSettings
 
 
+@lru_cache(maxsize=1)
+def load_environment():
+    """Load the .env file into os.environ once per process."""
+    load_dotenv()
+
+
 class AppSettings(BaseSettings):
     log_dir: Union[Path, None] = None
     img_dir: Union[Path, None] = None
@@ -1,11 +1,12 @@
 import sys
 import os
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 import multiprocessing
 import logging
-from dotenv import load_dotenv
 
 _log = logging.getLogger(__name__)
 
@@ -13,8 +14,18 @@ SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.dirname(SCRIPT_DIR))
 
 from app.routers import router
+from app.internal.data_manager import get_data_manager
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    ## connect to the db and create indexes in a worker thread before serving requests,
+    ## so the first request on each worker doesn't block the event loop doing it
+    await run_in_threadpool(get_data_manager)
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -26,8 +37,6 @@ app.add_middleware(
 
 app.include_router(router.router)
 
-load_dotenv()
-
 if __name__ == "__main__":
     multiprocessing.freeze_support()
     if "-d" in sys.argv or "--dev" in sys.argv:
@@ -18,11 +18,12 @@ from fastapi import (
     Depends,
     status,
 )
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import FileResponse, JSONResponse
 from fastapi.security import OAuth2PasswordBearer
 import zipfile
 
-from app.internal.data_manager import data_manager, Project, Roles
+from app.internal.data_manager import get_data_manager, Project, Roles
 from app.internal.image_handling import (
     process_single_file,
     process_document,
@@ -99,7 +100,9 @@ async def auth_login(request: Request):
         _log.info(f"unable to authenticate: {e}")
         raise HTTPException(status_code=401, detail=f"unable to authenticate: {e}")
 
-    role = data_manager.checkForUser(user_info, add=False, login=True)
+    role = await run_in_threadpool(
+        get_data_manager().checkForUser, user_info, add=False, login=True
+    )
     if role == "not found":
         _log.info(f"user is not authorized")
         raise HTTPException(status_code=403, detail=user_info)
@@ -137,7 +140,7 @@ async def auth_refresh(request: Request):
     except Exception as e:
         _log.info(f"unable to authenticate: {e}")
         raise HTTPException(status_code=401, detail=f"unable to authenticate: {e}")
-    role = data_manager.checkForUser(user_info)
+    role = await run_in_threadpool(get_data_manager().checkForUser, user_info)
     if role < Roles.base_user:
         _log.info(f"user is not authorized")
         raise HTTPException(status_code=403, detail=user_info)
@@ -156,8 +159,11 @@ async def check_authorization(user_info: dict = Depends(authenticate)):
     Returns:
         user account information
     """
-    role = data_manager.checkForUser(
-        {"email": user_info.get("email", "")}, update=False, add=False
+    role = await run_in_threadpool(
+        get_data_manager().checkForUser,
+        {"email": user_info.get("email", "")},
+        update=False,
+        add=False,
     )
     user_info["role"] = role
     return user_info
@@ -187,7 +193,9 @@ async def get_projects(user_info: dict = Depends(authenticate)):
     """
     Fetch all projects
     """
-    resp = data_manager.fetchProjects(user_info.get("email", ""))
+    resp = await run_in_threadpool(
+        get_data_manager().fetchProjects, user_info.get("email", "")
+    )
     return resp
 
 
@@ -201,8 +209,8 @@ async def get_project_data(project_id: str, user_info: dict = Depends(authentica
     Returns:
         Project data, all records associated with that project
     """
-    project_data, records = data_manager.fetchProjectData(
-        project_id, user_info.get("email", "")
+    project_data, records = await run_in_threadpool(
+        get_data_manager().fetchProjectData, project_id, user_info.get("email", "")
     )
     if project_data is None:
         raise HTTPException(
@@ -222,7 +230,7 @@ async def get_team_records(user_info: dict = Depends(authenticate)):
     Returns:
         Project data, all records associated with that project
     """
-    records = data_manager.getTeamRecords(user_info)
+    records = await run_in_threadpool(get_data_manager().getTeamRecords, user_info)
     return {"records": records}
 
 
@@ -236,7 +244,9 @@ async def get_record_data(record_id: str, user_info: dict = Depends(authenticate
     Returns:
         Record data
     """
-    record, is_locked = data_manager.fetchRecordData(record_id, user_info)
+    record, is_locked = await run_in_threadpool(
+        get_data_manager().fetchRecordData, record_id, user_info
+    )
     if record is None:
         raise HTTPException(
             403,
@@ -264,11 +274,17 @@ async def get_next_record(request: Request, user_info: dict = Depends(authentica
     reviewed = req.get("reviewed", False)
     reviewStatus = req.get("review_status", None)
     if reviewed:
-        data_manager.updateRecordReviewStatus(
-            data.get("_id", ""), reviewStatus, user_info
+        await run_in_threadpool(
+            get_data_manager().updateRecordReviewStatus,
+            data.get("_id", ""),
+            reviewStatus,
+            user_info,
         )
-    record, is_locked = data_manager.fetchNextRecord(
-        data.get("dateCreated", ""), data.get("project_id", ""), user_info
+    record, is_locked = await run_in_threadpool(
+        get_data_manager().fetchNextRecord,
+        data.get("dateCreated", ""),
+        data.get("project_id", ""),
+        user_info,
     )
     if is_locked:
         return JSONResponse(
@@ -290,8 +306,11 @@ async def get_previous_record(
         Record data
     """
     data = await request.json()
-    record, is_locked = data_manager.fetchPreviousRecord(
-        data.get("dateCreated", ""), data.get("project_id", ""), user_info
+    record, is_locked = await run_in_threadpool(
+        get_data_manager().fetchPreviousRecord,
+        data.get("dateCreated", ""),
+        data.get("project_id", ""),
+        user_info,
     )
     if is_locked:
         return JSONResponse(
@@ -313,7 +332,7 @@ async def add_project(request: Request, user_info: dict = Depends(authenticate))
     data = await request.json()
 
     # _log.info(f"adding project with data: {data}")
-    new_id = data_manager.createProject(data, user_info)
+    new_id = await run_in_threadpool(get_data_manager().createProject, data, user_info)
     return new_id
 
 
@@ -335,14 +354,18 @@ async def upload_document(
         New document record identifier.
     """
     user_email = user_email.lower()
-    user_info = data_manager.getUserInfo(user_email)
-    project_is_valid = data_manager.checkProjectValidity(project_id)
+    user_info = await run_in_threadpool(get_data_manager().getUserInfo, user_email)
+    project_is_valid = await run_in_threadpool(
+        get_data_manager().checkProjectValidity, project_id
+    )
     if not project_is_valid:
         raise HTTPException(404, detail=f"Project not found")
     filename, file_ext = os.path.splitext(file.filename)
     if file_ext.lower() == ".zip":
-        output_dir = f"{data_manager.app_settings.img_dir}"
-        return process_zip(
+        output_dir = f"{get_data_manager().app_settings.img_dir}"
+        ## extracting and sorting through the archive blocks, so keep it off the event loop
+        return await run_in_threadpool(
+            process_zip,
             project_id,
             user_info,
             background_tasks,
@@ -352,21 +375,25 @@ async def upload_document(
         )
 
     else:
-        original_output_path = f"{data_manager.app_settings.img_dir}/{file.filename}"
+        original_output_path = (
+            f"{get_data_manager().app_settings.img_dir}/{file.filename}"
+        )
         mime_type = file.content_type
         ## read document file
         try:
             async with aiofiles.open(original_output_path, "wb") as out_file:
                 content = await file.read()  # async read
                 await out_file.write(content)
-            return process_document(
+            ## record creation and pdf/tiff conversion block, so keep them off the event loop
+            return await run_in_threadpool(
+                process_document,
                 project_id,
                 user_info,
                 background_tasks,
                 original_output_path,
                 file_ext,
                 filename,
-                data_manager,
+                get_data_manager(),
                 mime_type,
             )
         except Exception as e:
@@ -388,7 +415,9 @@ async def update_project(
         Success response
     """
     data = await request.json()
-    data_manager.updateProject(project_id, data, user_info)
+    await run_in_threadpool(
+        get_data_manager().updateProject, project_id, data, user_info
+    )
 
     return {"response": "success"}
 
@@ -409,7 +438,9 @@ async def update_record(
     req = await request.json()
     data = req.get("data", None)
     update_type = req.get("type", None)
-    update = data_manager.updateRecord(record_id, data, update_type, user_info)
+    update = await run_in_threadpool(
+        get_data_manager().updateRecord, record_id, data, update_type, user_info
+    )
     if not update:
         raise HTTPException(status_code=403, detail=f"Record is locked by another user")
 
@@ -430,7 +461,9 @@ async def delete_project(
     Returns:
         Success response
     """
-    data_manager.deleteProject(project_id, background_tasks, user_info)
+    await run_in_threadpool(
+        get_data_manager().deleteProject, project_id, background_tasks, user_info
+    )
 
     return {"response": "success"}
 
@@ -445,7 +478,7 @@ async def delete_record(record_id: str, user_info: dict = Depends(authenticate))
     Returns:
         Success response
     """
-    data_manager.deleteRecord(record_id, user_info)
+    await run_in_threadpool(get_data_manager().deleteRecord, record_id, user_info)
 
     return {"response": "success"}
 
@@ -470,12 +503,16 @@ async def download_records(
     exportType = req.get("exportType", "csv")
     selectedColumns = req.get("columns", None)
 
-    export_file = data_manager.downloadRecords(
-        project_id, exportType, selectedColumns, user_info
+    export_file = await run_in_threadpool(
+        get_data_manager().downloadRecords,
+        project_id,
+        exportType,
+        selectedColumns,
+        user_info,
     )
     ## remove file after 30 seconds to allow for the user download to finish
     background_tasks.add_task(
-        data_manager.deleteFiles, filepaths=[export_file], sleep_time=30
+        get_data_manager().deleteFiles, filepaths=[export_file], sleep_time=30
     )
     return export_file
 
@@ -492,7 +529,12 @@ async def get_users(
     ## TODO: add team id as a request parameter
     req = await request.json()
     project_id = req.get("project_id", None)
-    users = data_manager.getUsers(Roles[role], user_info, project_id_exclude=project_id)
+    users = await run_in_threadpool(
+        get_data_manager().getUsers,
+        Roles[role],
+        user_info,
+        project_id_exclude=project_id,
+    )
     return users
 
 
@@ -511,7 +553,9 @@ async def add_contributors(
     ## TODO: change project to team
     req = await request.json()
     users = req.get("users", "")
-    return data_manager.addUsersToProject(users, project_id)
+    return await run_in_threadpool(
+        get_data_manager().addUsersToProject, users, project_id
+    )
 
 
 ## admin functions
@@ -526,8 +570,8 @@ async def approve_user(email: str, user_info: dict = Depends(authenticate)):
         approved user information
     """
     email = email.lower()
-    if data_manager.hasRole(user_info, Roles.admin):
-        return data_manager.approveUser(email)
+    if await run_in_threadpool(get_data_manager().hasRole, user_info, Roles.admin):
+        return await run_in_threadpool(get_data_manager().approveUser, email)
     else:
         raise HTTPException(
             status_code=403, detail=f"User is not authorized to perform this operation"
@@ -545,21 +589,32 @@ async def add_user(email: str, user_info: dict = Depends(authenticate)):
         user status
     """
     email = email.lower().replace(" ", "")
-    if data_manager.hasRole(user_info, Roles.admin):
+    if await run_in_threadpool(get_data_manager().hasRole, user_info, Roles.admin):
         ## TODO check if provided email is a valid email address
-        admin_document = data_manager.getDocument(
-            "users", {"email": user_info.get("email", "")}
+        admin_document = await run_in_threadpool(
+            get_data_manager().getDocument,
+            "users",
+            {"email": user_info.get("email", "")},
+            projection={"default_team": 1},
         )
         team = admin_document.get("default_team", None)
         ## this function will check for and then add user if it is not found
-        role = data_manager.checkForUser(
-            {"email": email}, update=False, team=team, add=False
+        role = await run_in_threadpool(
+            get_data_manager().checkForUser,
+            {"email": email},
+            update=False,
+            team=team,
+            add=False,
         )
         if role == "not found":
-            resp = data_manager.addUser({"email": email}, team, role=Roles.base_user)
+            resp = await run_in_threadpool(
+                get_data_manager().addUser, {"email": email}, team, role=Roles.base_user
+            )
         elif role > 0:
             ## TODO: in this case, just add user to team without creating new user
-            resp = data_manager.addUserToTeam(email, team, role=Roles.base_user)
+            resp = await run_in_threadpool(
+                get_data_manager().addUserToTeam, email, team, role=Roles.base_user
+            )
             if resp == "already_exists":
                 ## 406 Not acceptable: user provided an email that is already on this team
                 raise HTTPException(
@@ -588,8 +643,8 @@ async def delete_user(email: str, user_info: dict = Depends(authenticate)):
         result
     """
     email = email.lower()
-    if data_manager.hasRole(user_info, Roles.admin):
-        data_manager.deleteUser(email, user_info)
+    if await run_in_threadpool(get_data_manager().hasRole, user_info, Roles.admin):
+        await run_in_threadpool(get_data_manager().deleteUser, email, user_info)
         return {"Deleted", email}
 
     else: